@@ -1,9 +1,12 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Iterable, Optional, Tuple
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 from object_store_io import (
     S3Target,
@@ -18,32 +21,114 @@ MASTER_PARQUET = "master/AlphaPoliceEvent_master.parquet"
 MASTER_CSV = "master/AlphaPoliceEvent_master.csv"
 
 
-def _ensure_dedupe(df_new: pd.DataFrame) -> pd.DataFrame:
+def _with_string_keys(table: pa.Table) -> pa.Table:
+    # Keys are compared/concatenated as plain strings (older masters may not
+    # store them as strings at all)
+    idx = table.schema.get_field_index("_dedupe_key")
+    return table.set_column(idx, "_dedupe_key", table.column(idx).cast(pa.string()))
+
+
+def _ensure_dedupe(df_new: pd.DataFrame) -> pa.Table:
     if "_dedupe_key" not in df_new.columns:
         raise ValueError("df_new must include '_dedupe_key' before syncing.")
-    df = df_new.copy()
-    df["_dedupe_key"] = df["_dedupe_key"].astype(str)
-    return df
+    return _with_string_keys(pa.Table.from_pandas(df_new, preserve_index=False))
+
+
+def _check_key_format(master_keys: pa.ChunkedArray, new_keys: pa.ChunkedArray) -> None:
+    # No new key matches the master. That is expected after a long gap between
+    # runs, but if the keys don't even share a length the master was keyed by an
+    # older fallback format (e.g. 64-char SHA-256 vs 32-char BLAKE2b) and
+    # appending would duplicate the whole rolling window.
+    master_lengths = set(pc.unique(pc.utf8_length(master_keys)).to_pylist())
+    new_lengths = set(pc.unique(pc.utf8_length(new_keys)).to_pylist())
+    if master_lengths.isdisjoint(new_lengths):
+        raise ValueError(
+            "No new '_dedupe_key' matches the master and the key formats differ "
+            f"(lengths {sorted(master_lengths)} vs {sorted(new_lengths)}); the master "
+            "was keyed by an older fallback hash. Rebuild it from the archived "
+            "snapshots with `python src/rebuild_master.py`."
+        )
+
+
+def _merge(df_new: pd.DataFrame, master_path: Optional[Path]) -> Tuple[Optional[pa.Table], int]:
+    """
+    Returns (master table to write, rows appended); the table is None when the
+    existing master already holds every new row.
+    """
+    new_tbl = _ensure_dedupe(df_new)
 
+    if master_path is None:
+        return new_tbl, new_tbl.num_rows
 
-def _merge(df_new: pd.DataFrame, df_master: Optional[pd.DataFrame]) -> Tuple[pd.DataFrame, int]:
-    df_new = _ensure_dedupe(df_new)
+    if "_dedupe_key" not in pq.read_schema(master_path).names:
+        # If an old master without dedupe exists, rebuild from new
+        return new_tbl, new_tbl.num_rows
 
-    if df_master is None or df_master.empty:
-        return df_new, len(df_new)
+    # Anti-join in Arrow against the key column only (column projection)
+    master_keys = pq.read_table(master_path, columns=["_dedupe_key"]).column(0).cast(pa.string())
+    if len(master_keys) == 0:
+        return new_tbl, new_tbl.num_rows
 
-    if "_dedupe_key" not in df_master.columns:
-        # If an old master without dedupe exists, rebuild from new
-        return df_new, len(df_new)
+    mask = pc.invert(pc.is_in(new_tbl.column("_dedupe_key"), value_set=master_keys))
+    append_tbl = new_tbl.filter(mask)
+    if append_tbl.num_rows == 0:
+        return None, 0
+    if append_tbl.num_rows == new_tbl.num_rows:
+        _check_key_format(master_keys, new_tbl.column("_dedupe_key"))
 
-    df_master = df_master.copy()
-    df_master["_dedupe_key"] = df_master["_dedupe_key"].astype(str)
+    # Parquet can't be appended in place, so the full master is only decoded here
+    # for the rewrite. Schemas drift between runs (new/null columns), so let
+    # Arrow promote types.
+    master_tbl = _with_string_keys(pq.read_table(master_path))
+    out = pa.concat_tables([master_tbl, append_tbl], promote_options="permissive")
 
-    existing = set(df_master["_dedupe_key"])
-    df_append = df_new[~df_new["_dedupe_key"].isin(existing)].copy()
-    df_out = pd.concat([df_master, df_append], ignore_index=True)
+    return out, append_tbl.num_rows
 
-    return df_out, len(df_append)
+
+def _write_master(table: pa.Table, local_parquet: Path, local_csv: Path) -> None:
+    # The CSV is the public, human-facing copy: keep pandas' to_csv format
+    table.to_pandas().to_csv(local_csv, index=False)
+
+    # The pandas metadata is dropped: after type promotion it no longer describes
+    # the columns
+    table = table.replace_schema_metadata(None)
+    pq.write_table(table, local_parquet, compression="zstd", compression_level=3)
+
+
+def build_master(frames: Iterable[pd.DataFrame], workdir: Path) -> Tuple[Path, Path, int]:
+    """
+    Build a fresh master from scratch by merging frames (each with '_dedupe_key')
+    in order, the way successive runs would. Returns (parquet, csv, total rows).
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    local_parquet = workdir / "AlphaPoliceEvent_master.parquet"
+    local_csv = workdir / "AlphaPoliceEvent_master.csv"
+
+    built = False
+    for df_new in frames:
+        out_tbl, _ = _merge(df_new, local_parquet if built else None)
+        if out_tbl is not None:
+            _write_master(out_tbl, local_parquet, local_csv)
+            built = True
+
+    if not built:
+        raise ValueError("build_master needs at least one frame.")
+    return local_parquet, local_csv, pq.read_metadata(local_parquet).num_rows
+
+
+def _unchanged(store: str, local_parquet: Path) -> dict:
+    # Nothing new: the stored master is already current, nothing is rewritten
+    # or uploaded
+    return {
+        "store": store,
+        "master_existed": True,
+        "appended": 0,
+        "master_total": pq.read_metadata(local_parquet).num_rows,
+        "parquet_uri": None,
+        "csv_uri": None,
+    }
 
 
 def sync_master_s3(df_new: pd.DataFrame, workdir: Path, target: S3Target) -> dict:
@@ -57,12 +142,12 @@ def sync_master_s3(df_new: pd.DataFrame, workdir: Path, target: S3Target) -> dic
     local_csv = workdir / "AlphaPoliceEvent_master.csv"
 
     existed, _ = s3_download_if_exists(target, MASTER_PARQUET, local_parquet)
-    df_master = pd.read_parquet(local_parquet) if existed else None
 
-    df_out, appended = _merge(df_new, df_master)
+    out_tbl, appended = _merge(df_new, local_parquet if existed else None)
+    if out_tbl is None:
+        return _unchanged("s3", local_parquet)
 
-    df_out.to_parquet(local_parquet, index=False)
-    df_out.to_csv(local_csv, index=False)
+    _write_master(out_tbl, local_parquet, local_csv)
 
     parquet_uri = s3_upload(local_parquet, target, MASTER_PARQUET, content_type="application/octet-stream")
     csv_uri = s3_upload(local_csv, target, MASTER_CSV, content_type="text/csv")
@@ -71,7 +156,7 @@ def sync_master_s3(df_new: pd.DataFrame, workdir: Path, target: S3Target) -> dic
         "store": "s3",
         "master_existed": existed,
         "appended": appended,
-        "master_total": len(df_out),
+        "master_total": out_tbl.num_rows,
         "parquet_uri": parquet_uri,
         "csv_uri": csv_uri,
     }
@@ -87,22 +172,30 @@ def sync_master_gcs(df_new: pd.DataFrame, workdir: Path, target: GCSTarget) -> d
     local_parquet = workdir / "AlphaPoliceEvent_master.parquet"
     local_csv = workdir / "AlphaPoliceEvent_master.csv"
 
-    existed, _ = gcs_download_if_exists(target, MASTER_PARQUET, local_parquet)
-    df_master = pd.read_parquet(local_parquet) if existed else None
+    existed, _, generation = gcs_download_if_exists(target, MASTER_PARQUET, local_parquet)
 
-    df_out, appended = _merge(df_new, df_master)
+    out_tbl, appended = _merge(df_new, local_parquet if existed else None)
+    if out_tbl is None:
+        return _unchanged("gcs", local_parquet)
 
-    df_out.to_parquet(local_parquet, index=False)
-    df_out.to_csv(local_csv, index=False)
+    _write_master(out_tbl, local_parquet, local_csv)
 
-    parquet_uri = gcs_upload(local_parquet, target, MASTER_PARQUET, content_type="application/octet-stream")
+    # Only replace the master generation we merged against (0 = must not exist);
+    # conditional uploads are also retried by the client on transient errors
+    parquet_uri = gcs_upload(
+        local_parquet,
+        target,
+        MASTER_PARQUET,
+        content_type="application/octet-stream",
+        if_generation_match=generation if existed else 0,
+    )
     csv_uri = gcs_upload(local_csv, target, MASTER_CSV, content_type="text/csv")
 
     return {
         "store": "gcs",
         "master_existed": existed,
         "appended": appended,
-        "master_total": len(df_out),
+        "master_total": out_tbl.num_rows,
         "parquet_uri": parquet_uri,
         "csv_uri": csv_uri,
     }
@@ -1,18 +1,42 @@
 from __future__ import annotations
 
+import functools
 import json
 import os
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
+from google.api_core.exceptions import NotFound
 from google.cloud import storage as gcs_storage
 from google.oauth2 import service_account
 
 
+MB = 1024 * 1024
+
+# Multipart/threaded uploads kick in above 8 MB (master parquet/csv grow past this)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=8 * MB,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# GCS: files <= 8 MB go up as a single multipart request; larger files use a
+# resumable upload in the client's default 100 MiB chunks (one request for any
+# master below that size)
+GCS_UPLOAD_TIMEOUT = 120
+
+# Clients are built once per thread (boto3 sessions are not thread-safe) and
+# reused for every upload/download on that thread
+_clients = threading.local()
+
+
 @dataclass(frozen=True)
 class S3Target:
     bucket: str
@@ -37,7 +61,12 @@ def _join(prefix: str, key: str) -> str:
 
 def s3_client():
     # Uses env vars AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY/AWS_REGION on GitHub Actions
-    return boto3.client("s3", region_name=os.environ.get("AWS_REGION"))
+    client = getattr(_clients, "s3", None)
+    if client is None:
+        session = boto3.session.Session()
+        client = session.client("s3", region_name=os.environ.get("AWS_REGION"))
+        _clients.s3 = client
+    return client
 
 
 def s3_upload(local_path: Path, target: S3Target, key: str, content_type: Optional[str] = None) -> str:
@@ -49,7 +78,13 @@ def s3_upload(local_path: Path, target: S3Target, key: str, content_type: Option
     if content_type:
         extra["ContentType"] = content_type
 
-    s3.upload_file(str(local_path), target.bucket, obj_key, ExtraArgs=extra or None)
+    s3.upload_file(
+        str(local_path),
+        target.bucket,
+        obj_key,
+        ExtraArgs=extra or None,
+        Config=S3_TRANSFER_CONFIG,
+    )
     return f"s3://{target.bucket}/{obj_key}"
 
 
@@ -68,33 +103,76 @@ def s3_download_if_exists(target: S3Target, key: str, dest_path: Path) -> Tuple[
         raise
 
 
+def s3_list_keys(target: S3Target, prefix: str) -> List[str]:
+    """
+    Keys under prefix, relative to target.prefix (i.e. usable as `key` above).
+    """
+    s3 = s3_client()
+    root = _join(target.prefix, "")
+
+    keys = []
+    pages = s3.get_paginator("list_objects_v2").paginate(Bucket=target.bucket, Prefix=_join(target.prefix, prefix))
+    for page in pages:
+        keys.extend(obj["Key"][len(root):] for obj in page.get("Contents", []))
+    return keys
+
+
 # -------------------------
 # Google Cloud Storage
 # -------------------------
 
-def gcs_client_from_env():
-    """
-    Uses service account JSON passed in env var GCP_SA_JSON.
-    """
+@functools.lru_cache(maxsize=1)
+def _gcs_credentials():
     sa_json = os.environ["GCP_SA_JSON"]
     info = json.loads(sa_json)
     creds = service_account.Credentials.from_service_account_info(info)
-    return gcs_storage.Client(credentials=creds, project=info.get("project_id"))
+    return creds, info.get("project_id")
 
 
-def gcs_upload(local_path: Path, target: GCSTarget, key: str, content_type: Optional[str] = None) -> str:
+def gcs_client_from_env():
+    """
+    Uses service account JSON passed in env var GCP_SA_JSON.
+    """
+    client = getattr(_clients, "gcs", None)
+    if client is None:
+        creds, project = _gcs_credentials()
+        client = gcs_storage.Client(credentials=creds, project=project)
+        _clients.gcs = client
+    return client
+
+
+def gcs_upload(
+    local_path: Path,
+    target: GCSTarget,
+    key: str,
+    content_type: Optional[str] = None,
+    if_generation_match: Optional[int] = None,
+) -> str:
+    """
+    Pass if_generation_match (0 = object must not exist yet) to make the upload
+    conditional; the client library only auto-retries conditional uploads.
+    """
     local_path = Path(local_path)
     client = gcs_client_from_env()
     bucket = client.bucket(target.bucket)
 
     obj_key = _join(target.prefix, key)
     blob = bucket.blob(obj_key)
-    blob.upload_from_filename(str(local_path), content_type=content_type)
+    blob.upload_from_filename(
+        str(local_path),
+        content_type=content_type,
+        if_generation_match=if_generation_match,
+        timeout=GCS_UPLOAD_TIMEOUT,
+    )
 
     return f"gs://{target.bucket}/{obj_key}"
 
 
-def gcs_download_if_exists(target: GCSTarget, key: str, dest_path: Path) -> Tuple[bool, Path]:
+def gcs_download_if_exists(target: GCSTarget, key: str, dest_path: Path) -> Tuple[bool, Path, Optional[int]]:
+    """
+    Also returns the downloaded object's generation (None if missing), for use as
+    an if_generation_match precondition when writing it back.
+    """
     dest_path = Path(dest_path)
     client = gcs_client_from_env()
     bucket = client.bucket(target.bucket)
@@ -102,8 +180,21 @@ def gcs_download_if_exists(target: GCSTarget, key: str, dest_path: Path) -> Tupl
     obj_key = _join(target.prefix, key)
     blob = bucket.blob(obj_key)
 
-    if not blob.exists(client=client):
-        return False, dest_path
+    # Single round-trip: try the download and treat 404 as "missing" rather than
+    # checking exists() first (the client removes the partial file on NotFound)
+    try:
+        blob.download_to_filename(str(dest_path), client=client)
+    except NotFound:
+        return False, dest_path, None
+    return True, dest_path, blob.generation
+
+
+def gcs_list_keys(target: GCSTarget, prefix: str) -> List[str]:
+    """
+    Keys under prefix, relative to target.prefix (i.e. usable as `key` above).
+    """
+    client = gcs_client_from_env()
+    root = _join(target.prefix, "")
 
-    blob.download_to_filename(str(dest_path))
-    return True, dest_path
+    blobs = client.list_blobs(target.bucket, prefix=_join(target.prefix, prefix))
+    return [blob.name[len(root):] for blob in blobs]
@@ -1,12 +1,16 @@
 from __future__ import annotations
 
 import hashlib
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from itertools import chain
 from pathlib import Path
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from object_store_io import S3Target, GCSTarget, s3_upload, gcs_upload
 from master_sync import sync_master_s3, sync_master_gcs
@@ -14,41 +18,95 @@ from master_sync import sync_master_s3, sync_master_gcs
 
 # ArcGIS Feature Layer base URL
 LAYER_URL = "https://alphagis.alpharetta.ga.us/arcgis/rest/services/OpenData/OpenData_PS_Full/FeatureServer/0"
-def fetch_all_geojson(where: str = "1=1", batch_size: int = 2000) -> dict:
-    features = []
-    offset = 0
 
-    while True:
+# Shared keep-alive session for all ArcGIS calls: the pool covers the concurrent
+# page fetches, and throttling/transient errors are retried with backoff.
+# POST is retried too: the query endpoint is read-only.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
+
+def _arcgis_payload(r: requests.Response, key: str) -> dict:
+    # ArcGIS reports failed queries (throttling, bad params) as HTTP 200 with an
+    # {"error": ...} body; raise rather than let that pass as "no records"
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    if "error" in data:
+        raise RuntimeError(f"ArcGIS query failed: {data['error']}")
+    if key not in data:
+        raise RuntimeError(f"ArcGIS query returned no {key!r}: {sorted(data)}")
+    return data
+
+
+def fetch_object_ids(where: str = "1=1") -> list:
+    params = {
+        "where": where,
+        "returnIdsOnly": "true",
+        "f": "json",
+    }
+    r = SESSION.get(f"{LAYER_URL}/query", params=params, timeout=60)
+    data = _arcgis_payload(r, "objectIds")
+    # objectIds is null (not missing) when nothing matches
+    return sorted(data["objectIds"] or [])
+
+
+def fetch_all_geojson(where: str = "1=1", batch_size: int = 500, max_workers: int = 8) -> dict:
+    # Page by OBJECTID rather than resultOffset: the id list is fetched once, so
+    # pages are stable while the rolling window moves and can be fetched
+    # concurrently (max_workers stays low; ArcGIS throttles). Pages the server
+    # truncates are split until they fit its maxRecordCount.
+    ids = fetch_object_ids(where)
+
+    def fetch_page(page_ids: list) -> list:
         params = {
-            "where": where,
+            "objectIds": ",".join(str(i) for i in page_ids),
             "outFields": "*",
             "outSR": 4326,
             "f": "geojson",                 # <-- force GeoJSON
-            "resultOffset": offset,
-            "resultRecordCount": batch_size,
         }
-        r = requests.get(f"{LAYER_URL}/query", params=params, timeout=60)
-        r.raise_for_status()
-        data = r.json()
-
-        batch = data.get("features", [])
-        features.extend(batch)
-
-        if len(batch) < batch_size:
-            break
-        offset += batch_size
-
+        # POST: a few hundred ids don't fit comfortably in a query string
+        r = SESSION.post(f"{LAYER_URL}/query", data=params, timeout=60)
+        data = _arcgis_payload(r, "features")
+
+        # The layer's maxRecordCount is below this batch and the page was cut
+        # short: split it and refetch both halves rather than lose rows
+        exceeded = data.get("exceededTransferLimit") or (data.get("properties") or {}).get("exceededTransferLimit")
+        if exceeded:
+            if len(page_ids) == 1:
+                raise RuntimeError(f"ArcGIS transfer limit exceeded for a single OBJECTID: {page_ids[0]}")
+            mid = len(page_ids) // 2
+            return fetch_page(page_ids[:mid]) + fetch_page(page_ids[mid:])
+        return data["features"]
+
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pages = list(pool.map(fetch_page, batches))
+
+    features = list(chain.from_iterable(pages))
     return {"type": "FeatureCollection", "features": features}
 
 
 def flatten_geojson(fc: dict) -> pd.DataFrame:
-    rows = []
-    for feat in fc.get("features", []):
-        props = feat.get("properties") or {}
-        geom = feat.get("geometry") or {}
-        props["_geometry_json"] = json.dumps(geom, sort_keys=True)
-        rows.append(props)
-    return pd.DataFrame(rows)
+    features = fc.get("features", [])
+    df = pd.DataFrame([feat.get("properties") or {} for feat in features])
+    df["_geometry_json"] = [
+        orjson.dumps(feat.get("geometry") or {}, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+        for feat in features
+    ]
+    return df
 
 
 def add_dedupe_key(df: pd.DataFrame) -> pd.DataFrame:
@@ -57,25 +115,42 @@ def add_dedupe_key(df: pd.DataFrame) -> pd.DataFrame:
       - Use GlobalID if present (best)
       - Else hash a stable representation of the row (including geometry)
     """
-    df = df.copy()
+    # Only a column is added, so a shallow copy is enough to leave the input untouched
+    df = df.copy(deep=False)
 
     for col in ["GlobalID", "globalid", "GLOBALID"]:
         if col in df.columns:
             df["_dedupe_key"] = df[col].astype(str)
             return df
 
-    # fallback hash across all columns
+    # fallback hash across all columns; \x1f (unit separator) keeps the joined
+    # cells unambiguous without a per-row json.dumps
     cols = sorted(df.columns.tolist())
+    arr = df[cols].astype("string").fillna("").to_numpy()
+    joined = ["\x1f".join(r) for r in arr]
+    keys = [hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest() for s in joined]
 
-    def row_hash(row) -> str:
-        payload = {c: row.get(c) for c in cols}
-        s = json.dumps(payload, sort_keys=True, default=str)
-        return hashlib.sha256(s.encode("utf-8")).hexdigest()
-
-    df["_dedupe_key"] = df.apply(row_hash, axis=1)
+    df["_dedupe_key"] = pd.Series(keys, index=df.index)
     return df
 
 
+def _report(futures: dict) -> None:
+    """
+    Print each store's result (or failure) as it completes; the first failure is
+    re-raised only once every store has finished, so the log shows all outcomes.
+    """
+    labels = {fut: label for label, fut in futures.items()}
+    failed = []
+    for fut in as_completed(labels):
+        try:
+            print(fut.result())
+        except Exception as e:
+            print(f"{labels[fut]} failed: {e!r}")
+            failed.append(e)
+    if failed:
+        raise failed[0]
+
+
 def main():
     import os
 
@@ -96,21 +171,25 @@ def main():
     suffix = datetime.now().strftime("%Y%m%d")
     snap_name = f"AlphaPoliceEvent_{suffix}.geojson"
     snap_path = work_root / snap_name
-    snap_path.write_text(json.dumps(fc), encoding="utf-8")
-
-
-    # 3) Upload snapshot to BOTH stores
-    snap_key = f"snapshots/{snap_name}"
-    print(s3_upload(snap_path, s3_target, snap_key, content_type="application/geo+json"))
-    print(gcs_upload(snap_path, gcs_target, snap_key, content_type="application/geo+json"))
-
-    # 4) Independently update master on S3
-    s3_result = sync_master_s3(df_new, workdir=work_root / "s3_master", target=s3_target)
-    print(s3_result)
-
-    # 5) Independently update master on GCS
-    gcs_result = sync_master_gcs(df_new, workdir=work_root / "gcs_master", target=gcs_target)
-    print(gcs_result)
+    snap_path.write_bytes(orjson.dumps(fc))
+
+
+    # One worker thread per store, kept for both phases below: clients are cached
+    # per thread, so each store's client is built once and reused by its snapshot
+    # upload and its master sync, while the two stores run side by side
+    with ThreadPoolExecutor(max_workers=1) as s3_pool, ThreadPoolExecutor(max_workers=1) as gcs_pool:
+        # 3) Upload snapshot to BOTH stores
+        snap_key = f"snapshots/{snap_name}"
+        _report({
+            "s3 snapshot": s3_pool.submit(s3_upload, snap_path, s3_target, snap_key, content_type="application/geo+json"),
+            "gcs snapshot": gcs_pool.submit(gcs_upload, snap_path, gcs_target, snap_key, content_type="application/geo+json"),
+        })
+
+        # 4) Independently update master on S3 and GCS
+        _report({
+            "s3 master sync": s3_pool.submit(sync_master_s3, df_new, workdir=work_root / "s3_master", target=s3_target),
+            "gcs master sync": gcs_pool.submit(sync_master_gcs, df_new, workdir=work_root / "gcs_master", target=gcs_target),
+        })
 
 
 if __name__ == "__main__":
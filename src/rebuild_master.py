@@ -0,0 +1,115 @@
+"""
+Rebuild the master datasets from the archived snapshots.
+
+Run once when the fallback '_dedupe_key' format changes (layers without a
+GlobalID): the stored master's keys no longer match freshly computed ones, so
+the weekly sync refuses to append. Every snapshot is replayed oldest first with
+the current key and the result replaces the stored master.
+
+    python src/rebuild_master.py            # both stores
+    python src/rebuild_master.py s3         # or just one: s3 / gcs
+"""
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Callable, Iterator, List
+
+import orjson
+import pandas as pd
+
+from object_store_io import (
+    S3Target,
+    GCSTarget,
+    s3_download_if_exists,
+    s3_list_keys,
+    s3_upload,
+    gcs_download_if_exists,
+    gcs_list_keys,
+    gcs_upload,
+)
+from master_sync import MASTER_PARQUET, MASTER_CSV, build_master
+from pipeline import add_dedupe_key, flatten_geojson
+
+SNAPSHOT_PREFIX = "snapshots/AlphaPoliceEvent_"
+
+
+def _snapshot_keys(keys: List[str]) -> List[str]:
+    # Snapshot names end in _YYYYMMDD.geojson, so name order is date order
+    return sorted(k for k in keys if k.endswith(".geojson"))
+
+
+def _snapshot_frames(keys: List[str], download: Callable[[str, Path], bool], workdir: Path) -> Iterator[pd.DataFrame]:
+    for key in keys:
+        local_path = workdir / Path(key).name
+        if not download(key, local_path):
+            raise FileNotFoundError(key)
+        fc = orjson.loads(local_path.read_bytes())
+        print(f"replaying {key} ({len(fc.get('features', []))} features)")
+        yield add_dedupe_key(flatten_geojson(fc))
+        local_path.unlink()
+
+
+def rebuild_master_s3(workdir: Path, target: S3Target) -> dict:
+    """
+    Rebuild the S3 master from the S3 snapshots only (independent).
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    keys = _snapshot_keys(s3_list_keys(target, SNAPSHOT_PREFIX))
+    frames = _snapshot_frames(keys, lambda key, dest: s3_download_if_exists(target, key, dest)[0], workdir)
+    local_parquet, local_csv, total = build_master(frames, workdir / "master")
+
+    parquet_uri = s3_upload(local_parquet, target, MASTER_PARQUET, content_type="application/octet-stream")
+    csv_uri = s3_upload(local_csv, target, MASTER_CSV, content_type="text/csv")
+
+    return {
+        "store": "s3",
+        "snapshots": len(keys),
+        "master_total": total,
+        "parquet_uri": parquet_uri,
+        "csv_uri": csv_uri,
+    }
+
+
+def rebuild_master_gcs(workdir: Path, target: GCSTarget) -> dict:
+    """
+    Rebuild the GCS master from the GCS snapshots only (independent).
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    keys = _snapshot_keys(gcs_list_keys(target, SNAPSHOT_PREFIX))
+    frames = _snapshot_frames(keys, lambda key, dest: gcs_download_if_exists(target, key, dest)[0], workdir)
+    local_parquet, local_csv, total = build_master(frames, workdir / "master")
+
+    parquet_uri = gcs_upload(local_parquet, target, MASTER_PARQUET, content_type="application/octet-stream")
+    csv_uri = gcs_upload(local_csv, target, MASTER_CSV, content_type="text/csv")
+
+    return {
+        "store": "gcs",
+        "snapshots": len(keys),
+        "master_total": total,
+        "parquet_uri": parquet_uri,
+        "csv_uri": csv_uri,
+    }
+
+
+def main():
+    import os
+
+    stores = sys.argv[1:] or ["s3", "gcs"]
+    work_root = Path("work") / "rebuild"
+
+    if "s3" in stores:
+        s3_target = S3Target(bucket=os.environ["S3_BUCKET"], prefix=os.environ.get("S3_PREFIX", "alphapd"))
+        print(rebuild_master_s3(work_root / "s3", target=s3_target))
+
+    if "gcs" in stores:
+        gcs_target = GCSTarget(bucket=os.environ["GCS_BUCKET"], prefix=os.environ.get("GCS_PREFIX", "alphapd"))
+        print(rebuild_master_gcs(work_root / "gcs", target=gcs_target))
+
+
+if __name__ == "__main__":
+    main()